@@ -0,0 +1,214 @@
+import configparser
+import logging
+import logging.config
+import math
+import multiprocessing
+import queue
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from data_processor import DataProcessor
+from data_reader import Recording, create_readers, read_samples
+
+
+class SharedRingBuffer:
+    """Single writer ring buffer of float64 rows in shared memory.
+
+    The header holds a sequence counter, which is odd while a write is in progress,
+    and the total number of rows ever written. Readers never lock: they retry if the
+    counter changed while they were copying the new rows, for at most read_timeout seconds,
+    so a writer that died in the middle of a write does not hang them.
+    """
+
+    header_size = 2
+    read_timeout = 1.0
+    columns = ['dtime', 'temperature', 'voltage', 'current']
+
+    def __init__(self, name=None, capacity=4096, create=False):
+        self.capacity = capacity
+        self.channels = len(self.columns)
+        size = (self.header_size + capacity * self.channels) * 8
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        self.header = np.ndarray((self.header_size,), dtype=np.int64, buffer=self.shm.buf)
+        self.data = np.ndarray((capacity, self.channels), dtype=np.float64, buffer=self.shm.buf,
+                               offset=self.header_size * 8)
+        if create:
+            self.header[:] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def total(self):
+        return int(self.header[1])
+
+    def write(self, rows):
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, self.channels)
+        count = len(rows)
+        rows = rows[-self.capacity:]
+        total = int(self.header[1])
+        positions = (total + count - len(rows) + np.arange(len(rows))) % self.capacity
+        self.header[0] += 1
+        self.data[positions] = rows
+        self.header[1] = total + count
+        self.header[0] += 1
+
+    def read(self, since):
+        deadline = time.monotonic() + self.read_timeout
+        while time.monotonic() < deadline:
+            seq = int(self.header[0])
+            if seq % 2:
+                time.sleep(0)
+                continue
+            total = int(self.header[1])
+            start = max(since, total - self.capacity)
+            rows = self.data[np.arange(start, total) % self.capacity]
+            if int(self.header[0]) == seq:
+                return total, rows
+        raise TimeoutError(f'ring buffer {self.name} is being written for more than {self.read_timeout} sec')
+
+    def close(self, unlink=False):
+        self.header = None
+        self.data = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def encode_row(row):
+    return [
+        pd.Timestamp(row['dtime']).value / 1e9,
+        *[math.nan if row[c] is None or row[c] != row[c] else float(row[c]) for c in SharedRingBuffer.columns[1:]]
+    ]
+
+
+def acquisition_main(number, period, temperature_sources, buffer_names, capacity, commands, replies, stop_event,
+                     log_config=None):
+    # a spawned child starts with the default logging configuration
+    if log_config is not None:
+        logging.config.dictConfig(log_config)
+    logger = logging.getLogger('acquisition')
+    buffers = [SharedRingBuffer(name, capacity=capacity) for name in buffer_names]
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    data_readers, recording = create_readers(config, number)
+    data_processor = DataProcessor(number, persist=recording is None, temperature_sources=temperature_sources)
+    if recording is not None:
+        data_processor.clear()
+    # the GUI loads the same history itself, only new samples go through the buffers
+    data_processor.drain_events()
+    try:
+        while not stop_event.is_set():
+            t0 = time.time()
+            while True:
+                try:
+                    command, index, *args = commands.get_nowait()
+                except queue.Empty:
+                    break
+                if command == 'address':
+                    data_readers[index].set_address(*args)
+                elif command == 'reset':
+                    data_processor.reset(index)
+                elif command == 'seek' and recording is not None:
+                    recording.seek(*args)
+                    data_processor.clear()
+                    data_processor.drain_events()
+                    # rows written before the seek are skipped by the GUI
+                    replies.put(('seek', [buffer.total for buffer in buffers]))
+            samples = read_samples(data_readers, recording, logger)
+            data_processor.add_samples(samples, recording.now() if recording is not None else None)
+            updated = []
+            for kind, i, _, rows in data_processor.drain_events():
+                if kind == 'append':
+                    buffers[i].write([encode_row(row) for _, row in rows.iterrows()])
+                    updated.append(i)
+            logger.debug(f'cycle {round(time.time() - t0, 3)} sec, updated: {updated}')
+            timeout = period - (time.time() - t0)
+            if recording is not None and recording.finished():
+                # nothing left to replay until a seek
+                timeout = max(timeout, Recording.idle_period)
+            stop_event.wait(max(timeout, 0))
+    finally:
+        for data_reader in data_readers:
+            if hasattr(data_reader, 'close'):
+                data_reader.close()
+        for buffer in buffers:
+            buffer.close()
+
+
+class AcquisitionProcess:
+    """Runs the read/ingest loop in a child process and publishes samples through shared memory."""
+
+    poll_period = 0.5
+
+    def __init__(self, number, period, temperature_sources, capacity=4096, log_config=None):
+        self.logger = logging.getLogger('manager')
+        context = multiprocessing.get_context('spawn')
+        self.buffers = [SharedRingBuffer(capacity=capacity, create=True) for _ in range(number)]
+        self.positions = [0] * number
+        self.commands = context.Queue()
+        self.replies = context.Queue()
+        self.seeking = 0
+        self.stop_event = context.Event()
+        self.process = context.Process(
+            target=acquisition_main,
+            args=(number, period, temperature_sources, [b.name for b in self.buffers], capacity,
+                  self.commands, self.replies, self.stop_event, log_config),
+            daemon=True)
+        self.alive = True
+
+    def start(self):
+        self.process.start()
+        self.logger.info(f'acquisition process started, pid: {self.process.pid}')
+
+    def stop(self):
+        # setting the event waits for its waiters to wake up, a dead child never does
+        if self.process.is_alive():
+            self.stop_event.set()
+            self.process.join(timeout=10.0)
+        if self.process.is_alive():
+            self.logger.error('acquisition process does not stop, terminate')
+            self.process.terminate()
+            self.process.join()
+        for buffer in self.buffers:
+            buffer.close(unlink=True)
+
+    def set_address(self, index, address):
+        self.commands.put(('address', index, address))
+
+    def reset(self, index):
+        self.commands.put(('reset', index))
+
+    def seek(self, dtime):
+        self.commands.put(('seek', None, dtime))
+        self.seeking += 1
+
+    def collect(self, data_processor):
+        if not self.process.is_alive():
+            if self.alive:
+                self.alive = False
+                self.logger.error(f'acquisition process died, exit code: {self.process.exitcode}')
+            return []
+        while self.seeking:
+            try:
+                reply, positions = self.replies.get_nowait()
+            except queue.Empty:
+                # the rows in the buffers are still from before the seek
+                return []
+            if reply == 'seek':
+                self.seeking -= 1
+                self.positions = positions
+        rows = {}
+        for i, buffer in enumerate(self.buffers):
+            try:
+                total, rows[i] = buffer.read(self.positions[i])
+            except TimeoutError as ex:
+                self.logger.error(f'read #{i} error: {ex}')
+                continue
+            self.positions[i] = total
+        data_processor.add_rows(rows)
+        return [i for i, r in rows.items() if len(r)]
@@ -1,70 +1,308 @@
 import os
 import pickle
-from datetime import datetime, timedelta
+import threading
+import zipfile
+from datetime import datetime
 
+import numpy as np
 import pandas as pd
 
 
+class AlignedStore:
+    """Samples of all sensors aligned by poll cycle as a time x sensor x channel array."""
+
+    channels = ['temperature', 'voltage', 'current']
+
+    def __init__(self, sensors, capacity=1024):
+        self.sensors = sensors
+        self.size = 0
+        self.times = np.empty(capacity, dtype='datetime64[ns]')
+        self.values = np.full((capacity, sensors, len(self.channels)), np.nan)
+
+    def begin_cycle(self, dtime):
+        if self.size == len(self.times):
+            self.times = np.concatenate([self.times, np.empty_like(self.times)])
+            self.values = np.concatenate([self.values, np.full_like(self.values, np.nan)])
+        dtime = np.datetime64(dtime, 'ns')
+        if self.size and dtime < self.times[self.size - 1]:
+            # keep the index sorted, a late cycle gets a new row with the time of the last one
+            dtime = self.times[self.size - 1]
+        self.times[self.size] = dtime
+        self.values[self.size] = np.nan
+        self.size += 1
+
+    def put(self, sensor, dtime, data):
+        # as-of alignment: a late sample goes to the last cycle started before it was taken
+        row = np.searchsorted(self.times[:self.size], np.datetime64(dtime, 'ns'), side='right') - 1
+        if row < 0:
+            return False
+        self.values[row, sensor] = [np.nan if data.get(c) is None else data.get(c) for c in self.channels]
+        return True
+
+    def set_last(self, sensor, channel, value):
+        if self.size and not np.isnan(self.values[self.size - 1, sensor]).all():
+            self.values[self.size - 1, sensor, self.channels.index(channel)] = value
+
+    def last(self, name):
+        if not self.size:
+            return np.full(self.sensors, np.nan)
+        return self.values[self.size - 1, :, self.channels.index(name)]
+
+    def channel(self, name):
+        return self.values[:self.size, :, self.channels.index(name)]
+
+    def spread(self, name, t0=None):
+        """Difference between the highest and the lowest value of all sensors for every cycle after t0."""
+        start = 0 if t0 is None else np.searchsorted(self.times[:self.size], np.datetime64(t0, 'ns'), side='right')
+        values = self.channel(name)[start:]
+        valid = ~np.isnan(values).all(axis=1)
+        spread = np.full(len(values), np.nan)
+        spread[valid] = np.nanmax(values[valid], axis=1) - np.nanmin(values[valid], axis=1)
+        return self.times[start:self.size], spread
+
+    def trim(self, start_time):
+        start = np.searchsorted(self.times[:self.size], np.datetime64(start_time, 'ns'), side='right')
+        if start:
+            self.times[:self.size - start] = self.times[start:self.size]
+            self.values[:self.size - start] = self.values[start:self.size]
+            self.size -= start
+
+    def reset(self, sensor):
+        self.values[:self.size, sensor] = np.nan
+
+    def clear(self):
+        self.size = 0
+
+    def save(self, path):
+        # np.savez adds the .npz extension
+        tmp_path = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, times=self.times[:self.size], values=self.values[:self.size])
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        with np.load(path) as data:
+            times, values = data['times'], data['values']
+        if values.shape[1:] != self.values.shape[1:]:
+            return
+        self.size = 0
+        for dtime, row in zip(times, values):
+            self.begin_cycle(dtime)
+            self.values[self.size - 1] = row
+
+
 class DataProcessor:
 
-    def __init__(self, count):
+    def __init__(self, count, persist=True, temperature_sources=None, history=True):
+        self.persist = persist
         self.columns = ['dtime', 'temperature', 'voltage', 'current']
-        self.dfs = [pd.DataFrame(data=[], columns=self.columns) for i in range(count)]
-        self.temperature = None
-        self.load()
+        self.dfs = [self.normalize(pd.DataFrame(data=[], columns=self.columns)) for i in range(count)]
+        # sorted sample times of every frame in int64 nanoseconds
+        self.times = [np.empty(0, dtype=np.int64) for i in range(count)]
+        self.store = AlignedStore(count)
+        if temperature_sources is None:
+            temperature_sources = [None] + [0] * (count - 1)
+        self.temperature_sources = temperature_sources
+        # changes since the last drain_events call: appended and truncated row counts, reset sensors
+        self.seq = 0
+        self.appended = {}
+        self.truncated = {}
+        self.resets = []
+        self.lock = threading.Lock()
+        if history:
+            self.load()
 
     def add_data(self, idx, data):
-        df = self.dfs[idx]
-        values = [data.get(c) for c in self.columns]
-        values[0] = datetime.now()
-        df_data = pd.DataFrame(data=[values], columns=self.columns)
-        df_data = self.calc_extra_data(df_data)
-        if idx == 0 and self.temperature is None and not df_data.empty and df_data['temperature'].values[0] is not None:
-            self.temperature = df_data['temperature'].values[0]
-        df = pd.concat([df, df_data], ignore_index=True)
-        start_time = datetime.now() - timedelta(hours=12)
-        df = df[df['dtime'] > start_time]
-        self.dfs[idx] = df
+        self.add_batch(idx, [data])
+
+    def add_batch(self, idx, samples):
+        if not samples:
+            return
+        rows = [[data.get(c) for c in self.columns] for data in samples]
+        for values, data in zip(rows, samples):
+            values[0] = data.get('dtime') or datetime.now()
+        df_data = pd.DataFrame(data=rows, columns=self.columns)
+        df_data = self.calc_extra_data(self.normalize(df_data))
+        self.append_frame(idx, df_data)
+
+    def add_rows(self, rows):
+        """Appends already processed float rows (dtime as epoch seconds, temperature, voltage, current) by sensor.
+
+        Used for samples ingested by another process, so no temperature mapping and no saving is done.
+        """
+        rows = {idx: r for idx, r in rows.items() if len(r)}
+        if not rows:
+            return
+        times = {idx: (np.round(r[:, 0] * 1e6).astype('int64') * 1000).view('datetime64[ns]')
+                 for idx, r in rows.items()}
+        self.begin_circle(min(t[0] for t in times.values()))
+        for idx, r in rows.items():
+            df_data = pd.DataFrame({
+                'dtime': times[idx],
+                'temperature': r[:, 1],
+                'voltage': r[:, 2],
+                'current': r[:, 3],
+            })
+            self.append_frame(idx, self.calc_extra_data(df_data))
+        self.trim_store()
+
+    def append_frame(self, idx, df_data):
+        for row in df_data[['dtime', *AlignedStore.channels]].itertuples(index=False):
+            self.store.put(idx, row.dtime, row._asdict())
+        count = len(df_data)
+        times = np.concatenate([self.times[idx], df_data['dtime'].values.astype('datetime64[ns]').view('int64')])
+        df = pd.concat([self.dfs[idx], df_data], ignore_index=True)
+        reordered = bool(np.any(np.diff(times[-count - 1:]) < 0))
+        if reordered:
+            order = np.argsort(times, kind='stable')
+            times = times[order]
+            df = df.iloc[order].reset_index(drop=True)
+        start = np.searchsorted(times, times[-1] - pd.Timedelta(hours=12).value, side='right')
+        with self.lock:
+            self.times[idx] = times[start:]
+            self.dfs[idx] = df.iloc[start:]
+            if reordered:
+                # out of order samples are announced as a reset followed by the whole frame
+                self.resets.append(idx)
+                self.truncated.pop(idx, None)
+                self.appended[idx] = len(self.times[idx])
+            else:
+                appended = self.appended.get(idx, 0)
+                removed_new = max(0, start - (len(times) - count - appended))
+                self.appended[idx] = appended + count - removed_new
+                self.truncated[idx] = self.truncated.get(idx, 0) + start - removed_new
+
+    def query(self, sensor, t0=None, t1=None, fields=None, max_points=None):
+        """Samples of the sensor with t0 <= dtime <= t1 as numpy arrays by field.
+
+        The range is found by binary search in the time index, the arrays are slices of the
+        frame columns, so nothing is copied. With max_points the samples are thinned out to
+        max_points evenly spaced ones, always keeping the first and the last one.
+        """
+        with self.lock:
+            df, times = self.dfs[sensor], self.times[sensor]
+        i0 = 0 if t0 is None else np.searchsorted(times, pd.Timestamp(t0).value, side='left')
+        i1 = len(times) if t1 is None else np.searchsorted(times, pd.Timestamp(t1).value, side='right')
+        rows = slice(i0, i1)
+        if max_points and i1 - i0 > max_points:
+            rows = np.linspace(i0, i1 - 1, max_points).round().astype(np.int64)
+        data = {'dtime': times[rows].view('datetime64[ns]')}
+        for field in fields or [c for c in df.columns if c != 'dtime']:
+            data[field] = df[field].to_numpy()[rows]
+        return data
+
+    def integral(self, sensor, t0, t1, field='current'):
+        data = self.query(sensor, t0, t1, [field])
+        if len(data['dtime']) < 2:
+            return 0.0
+        seconds = data['dtime'].view('int64') * 1e-9
+        values = data[field]
+        # trapezoidal rule, in ampere-hours for the current
+        return float(np.sum((values[1:] + values[:-1]) * np.diff(seconds)) / 2) / 3600
+
+    def add_samples(self, samples, dtime=None):
+        # the cycle starts with its oldest sample, so late samples do not fall into the previous row
+        if not samples:
+            return
+        by_sensor = {}
+        for idx, data in samples:
+            by_sensor.setdefault(idx, []).append(data)
+        times = [data['dtime'] for _, data in samples if data.get('dtime')]
+        self.begin_circle(min(times + [dtime or datetime.now()]))
+        for idx, data in sorted(by_sensor.items()):
+            self.add_batch(idx, data)
+        self.end_circle()
 
     def calc_extra_data(self, df):
-        def capacity(data):
-            if data >= 13.0:
-                return 100
-            if data <= 11.6:
-                return 0
-            return round(66.67 * (data - 11.5))
-
-        df['temperature'] = df.apply(lambda x: x['temperature'] if x['temperature'] > -50 else None, axis=1)
+        temperature = df['temperature'].where(df['temperature'] > -50)
+        voltage = df['voltage']
+        df['temperature'] = temperature
         df['ideal_temp'] = 25.0
-        df['max_charging_voltage'] = df['temperature'].apply(
-            lambda x: 15.4 - 0.03 * (x if (x is not None) and (x > -40) else 0))
-        df['capacity'] = df['voltage'].apply(capacity)
+        df['max_charging_voltage'] = 15.4 - 0.03 * temperature.where(temperature > -40, 0.0)
+        capacity = (66.67 * (voltage - 11.5)).round()
+        df['capacity'] = capacity.mask(voltage >= 13.0, 100.0).mask(voltage <= 11.6, 0.0)
         return df
 
-    def begin_circle(self):
-        self.temperature = None
+    def normalize(self, df):
+        df = df.astype({c: float for c in df.columns if c != 'dtime'})
+        df['dtime'] = pd.to_datetime(df['dtime'])
+        return df
+
+    def begin_circle(self, dtime=None):
+        self.store.begin_cycle(dtime or datetime.now())
 
     def end_circle(self):
-        if self.temperature is not None:
-            for df in self.dfs[1:]:
-                if not df.empty:
-                    df.loc[df.index[-1], 'temperature'] = self.temperature
-        self.save()
+        # temperature of the cycle from the source sensor of every pack
+        temperatures = self.store.last('temperature').copy()
+        for i, df in enumerate(self.dfs):
+            source = self.temperature_sources[i]
+            if source is None or source == i or np.isnan(temperatures[source]):
+                continue
+            if self.appended.get(i):
+                df.loc[df.index[-1], 'temperature'] = temperatures[source]
+            self.store.set_last(i, 'temperature', temperatures[source])
+        self.trim_store()
+        if self.persist:
+            self.save()
+
+    def trim_store(self):
+        if self.store.size:
+            self.store.trim(self.store.times[self.store.size - 1] - np.timedelta64(12, 'h'))
+
+    def drain_events(self):
+        """Changes since the previous call as (kind, sensor, seq, payload) tuples in order.
+
+        kind is 'reset' (payload None), 'truncate' (number of rows removed from the head) or
+        'append' (frame with the new rows only).
+        """
+        events = []
+        with self.lock:
+            for idx in self.resets:
+                events.append(['reset', idx, None])
+            for idx, count in sorted(self.truncated.items()):
+                if count:
+                    events.append(['truncate', idx, count])
+            for idx, count in sorted(self.appended.items()):
+                if count:
+                    events.append(['append', idx, self.dfs[idx].iloc[-count:]])
+            self.resets, self.truncated, self.appended = [], {}, {}
+            for event in events:
+                self.seq += 1
+                event.insert(2, self.seq)
+        return [tuple(event) for event in events]
 
     def reset(self, number):
-        self.dfs[number] = self.dfs[number][0:0]
+        with self.lock:
+            self.dfs[number] = self.dfs[number][0:0]
+            self.times[number] = self.times[number][0:0]
+            self.resets.append(number)
+            self.truncated.pop(number, None)
+            self.appended.pop(number, None)
+        self.store.reset(number)
+
+    def clear(self):
+        for i in range(len(self.dfs)):
+            self.reset(i)
+        self.store.clear()
 
     def save(self):
         if not os.path.exists('data'):
             os.mkdir('data')
         for i, df in enumerate(self.dfs):
             df.to_pickle(f'data/{i + 1}.pickle')
+        self.store.save('data/store.npz')
 
     def load(self):
         if os.path.exists('data'):
             for i, df in enumerate(self.dfs):
                 try:
-                    df = pd.read_pickle(f'data/{i + 1}.pickle')
+                    df = self.normalize(pd.read_pickle(f'data/{i + 1}.pickle'))
+                    df = df.sort_values('dtime', ignore_index=True)
                     self.dfs[i] = df
+                    self.times[i] = df['dtime'].values.astype('datetime64[ns]').view('int64')
+                    self.appended[i] = len(df)
                 except (FileNotFoundError, pickle.UnpicklingError):
                     continue
+            try:
+                self.store.load('data/store.npz')
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+                pass
@@ -1,8 +1,16 @@
 import logging
-from datetime import datetime
+import os
+import pickle
+import threading
+from collections import deque
+from datetime import datetime, timedelta
 from time import sleep
 import socket
 import random
+import time
+
+import numpy as np
+import pandas as pd
 
 
 class DataReader:
@@ -49,6 +57,119 @@ class DataReader:
         self.address = address
 
 
+class StreamParser:
+    """Incremental parser of the 't:<temperature>;v:<voltage>;c:<current>' lines of the stream mode.
+
+    The lines of one chunk are timestamped evenly between the previous and the current receive time,
+    the lines of the first chunk sample_interval seconds apart.
+    """
+
+    sample_interval = 0.1
+
+    def __init__(self):
+        self.buffer = ''
+        self.last_received = None
+
+    def feed(self, data, received=None):
+        received = received or datetime.now()
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split('\n')
+        if self.last_received is None:
+            self.last_received = received - timedelta(seconds=self.sample_interval) * len(lines)
+        last_received, self.last_received = self.last_received, received
+        step = (received - last_received) / len(lines) if lines else None
+        samples = []
+        for k, line in enumerate(lines):
+            line = line.strip()
+            if not line or line.startswith('<'):
+                continue
+            try:
+                t, v, c = [float(l.split(':')[1]) for l in line.split(';')]
+            except (IndexError, ValueError):
+                continue
+            samples.append({
+                'dtime': last_received + step * (k + 1),
+                'current': c,
+                'voltage': v,
+                'temperature': t,
+            })
+        return samples
+
+
+class StreamDataReader(DataReader):
+    """Subscribes to the device once and collects the samples it pushes in a background thread."""
+
+    reconnect_period = 5.0
+    max_samples = 100000
+
+    def __init__(self, number, address):
+        super().__init__(number, address)
+        self.samples = deque(maxlen=self.max_samples)
+        self.connection = None
+        self.thread = None
+        self.__run = True
+
+    def read(self):
+        samples = self.read_batch()
+        return samples[-1] if samples else None
+
+    def read_batch(self):
+        if self.thread is None and self.address:
+            self.thread = threading.Thread(target=self.loop, daemon=True)
+            self.thread.start()
+        samples = []
+        while self.samples:
+            samples.append(self.samples.popleft())
+        return samples
+
+    def loop(self):
+        while self.__run:
+            address = self.address
+            if address:
+                try:
+                    self.receive(address)
+                except OSError as ex:
+                    self.logger.error(f'stream error: {ex}')
+                except Exception:
+                    self.logger.exception('stream reader error')
+            if self.__run:
+                sleep(self.reconnect_period)
+
+    def receive(self, address):
+        with socket.socket(socket.AF_BLUETOOTH,
+                           socket.SOCK_STREAM,
+                           socket.BTPROTO_RFCOMM) as c:
+            c.connect((address, 1))
+            self.connection = c
+            try:
+                self.logger.debug('stream connected')
+                c.send(b'start_stream')
+                parser = StreamParser()
+                while self.__run and self.address == address:
+                    data = c.recv(1024)
+                    if not data:
+                        raise ConnectionError('stream closed')
+                    self.samples.extend(parser.feed(data.decode(errors='replace'), datetime.now()))
+            finally:
+                self.connection = None
+
+    def set_address(self, address):
+        super().set_address(address)
+        self.disconnect()
+
+    def close(self):
+        self.__run = False
+        self.disconnect()
+
+    def disconnect(self):
+        connection = self.connection
+        if connection is not None:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
 class SimDataReader:
 
     def __init__(self, number, address, *args, **kwargs):
@@ -65,3 +186,150 @@ class SimDataReader:
 
     def set_address(self, address):
         self.address = address
+
+
+class Recording:
+    """Recorded history (N.pickle files of the data folder) replayed with a per-sensor time index.
+
+    speed is the replay rate relative to real time, 0 replays as fast as possible, step seconds
+    of the recording per cycle.
+    """
+
+    columns = ['temperature', 'voltage', 'current']
+    # loop period once the whole recording is replayed, until a seek
+    idle_period = 1.0
+
+    def __init__(self, path, count, speed=1.0, step=60.0):
+        self.logger = logging.getLogger('data_reader.replay')
+        self.speed = speed
+        self.step = int(step * 1e9)
+        self.dfs = []
+        self.times = []
+        for i in range(count):
+            try:
+                df = pd.read_pickle(os.path.join(path, f'{i + 1}.pickle')).sort_values('dtime', ignore_index=True)
+            except (FileNotFoundError, pickle.UnpicklingError) as ex:
+                if not isinstance(ex, FileNotFoundError):
+                    self.logger.error(f'recording of #{i} is not loaded: {ex}')
+                df = pd.DataFrame(data=[], columns=['dtime', *self.columns])
+            self.dfs.append(df)
+            self.times.append(pd.to_datetime(df['dtime']).values.astype('datetime64[ns]').view('int64'))
+        self.logger.info(f'recording {path} loaded, samples: {[len(t) for t in self.times]}')
+        self.positions = [0] * count
+        self.origin = 0
+        self.virtual = 0
+        self.wall_origin = time.time()
+        self.ended = False
+        first = [t[0] for t in self.times if len(t)]
+        self.seek(pd.Timestamp(min(first)) if first else datetime.now())
+
+    def seek(self, dtime):
+        t = pd.Timestamp(dtime).value
+        self.positions = [int(np.searchsorted(times, t)) for times in self.times]
+        self.origin = t
+        self.virtual = t
+        self.wall_origin = time.time()
+        self.ended = False
+        self.logger.info(f'seek to {pd.Timestamp(t)}')
+
+    @staticmethod
+    def scale_period(period, speed):
+        return period / speed if speed else 0.0
+
+    def finished(self):
+        return all(pos >= len(times) for times, pos in zip(self.times, self.positions))
+
+    def tick(self):
+        if self.finished():
+            if not self.ended:
+                self.ended = True
+                self.logger.info('end of the recording')
+            return
+        # as fast as possible: every cycle replays the next step of the recording
+        if not self.speed:
+            pending = [times[pos] for times, pos in zip(self.times, self.positions) if pos < len(times)]
+            if pending:
+                self.virtual = max(self.virtual, min(pending) + self.step - 1000)
+
+    def now_value(self):
+        if self.speed:
+            return self.origin + int((time.time() - self.wall_origin) * self.speed * 1e6) * 1000
+        return self.virtual
+
+    def now(self):
+        return pd.Timestamp(self.now_value()).to_pydatetime()
+
+    def next_batch(self, number):
+        times, pos = self.times[number], self.positions[number]
+        end = int(np.searchsorted(times, self.now_value(), side='right'))
+        if end <= pos:
+            return []
+        self.positions[number] = end
+        values = self.dfs[number][self.columns].iloc[pos:end].astype(float).to_numpy()
+        return [
+            {'dtime': pd.Timestamp(t).to_pydatetime(), **dict(zip(self.columns, row))}
+            for t, row in zip(times[pos:end], values)
+        ]
+
+
+class ReplayDataReader:
+
+    def __init__(self, number, address, recording, *args, **kwargs):
+        self.number = number
+        self.address = address
+        self.recording = recording
+
+    def read(self):
+        samples = self.read_batch()
+        return samples[-1] if samples else None
+
+    def read_batch(self):
+        return self.recording.next_batch(self.number)
+
+    def set_address(self, address):
+        self.address = address
+
+
+def read_addresses(config, number):
+    return [config.get('DataReader', f'bt_{i + 1}', fallback=None) or None for i in range(number)]
+
+
+def create_readers(config, number):
+    addresses = read_addresses(config, number)
+    reader = config.get('DataReader', 'reader', fallback='bluetooth')
+    recording = None
+    if reader == 'replay':
+        recording = Recording(config.get('Replay', 'path', fallback='replay'), number,
+                              speed=config.getfloat('Replay', 'speed', fallback=1.0),
+                              step=config.getfloat('DataReader', 'period', fallback=60.0))
+        start = config.get('Replay', 'start', fallback='')
+        if start:
+            recording.seek(start)
+        readers = [ReplayDataReader(i, addr, recording) for i, addr in zip(range(number), addresses)]
+    elif reader == 'stream':
+        readers = [StreamDataReader(i, address=addr) for i, addr in zip(range(number), addresses)]
+    elif reader == 'sim':
+        readers = [SimDataReader(i, addr) for i, addr in zip(range(number), addresses)]
+    else:
+        readers = [DataReader(i, address=addr) for i, addr in zip(range(number), addresses)]
+    return readers, recording
+
+
+def read_samples(data_readers, recording=None, logger=None):
+    """Reads all readers once and returns the new samples as (sensor, sample) pairs."""
+    logger = logger or logging.getLogger('data_reader')
+    if recording is not None:
+        recording.tick()
+    samples = []
+    for i, data_reader in enumerate(data_readers):
+        try:
+            if hasattr(data_reader, 'read_batch'):
+                batch = data_reader.read_batch()
+            else:
+                data = data_reader.read()
+                batch = [data] if data else []
+        except Exception as ex:
+            logger.error(f'read #{i} error: {ex}')
+            continue
+        samples.extend((i, data) for data in batch)
+    return samples
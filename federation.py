@@ -0,0 +1,251 @@
+import json
+import logging
+import math
+import queue
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+
+
+def encode_sample(index, row):
+    values = [row[c] for c in ('temperature', 'voltage', 'current')]
+    return [index, row['dtime'].timestamp(), *[None if v is None or v != v else float(v) for v in values]]
+
+
+def send_message(sock, message):
+    sock.sendall(json.dumps(message).encode() + b'\n')
+
+
+def read_messages(sock, buffer):
+    data = sock.recv(65536)
+    if not data:
+        raise ConnectionError('connection closed')
+    buffer += data
+    *lines, rest = buffer.split(b'\n')
+    return [json.loads(line) for line in lines if line.strip()], rest
+
+
+class GatewayClient:
+
+    def __init__(self, sock, address, queue_size):
+        self.sock = sock
+        self.address = address
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class GatewayServer:
+    """Serves the samples of this instance to federation collectors over TCP.
+
+    Every cycle is sent as one batch message with the sensors reset in the cycle and the new samples,
+    each client has its own send queue and thread, a client that does not keep up is disconnected.
+    """
+
+    queue_size = 100
+    send_timeout = 5.0
+
+    def __init__(self, port, sensors, host=''):
+        self.logger = logging.getLogger('manager.gateway')
+        self.sensors = sensors
+        self.server = socket.create_server((host, port))
+        self.clients = []
+        self.lock = threading.Lock()
+        self.__run = True
+
+    def start(self):
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def stop(self):
+        self.__run = False
+        self.server.close()
+        with self.lock:
+            for client in self.clients:
+                client.close()
+
+    def accept_loop(self):
+        while self.__run:
+            try:
+                sock, address = self.server.accept()
+            except OSError:
+                break
+            self.logger.info(f'collector connected: {address}')
+            sock.settimeout(self.send_timeout)
+            client = GatewayClient(sock, address, self.queue_size)
+            client.queue.put({'type': 'hello', 'sensors': self.sensors})
+            with self.lock:
+                self.clients.append(client)
+            threading.Thread(target=self.send_loop, args=(client,), daemon=True).start()
+            threading.Thread(target=self.receive_loop, args=(client,), daemon=True).start()
+
+    def publish(self, samples, resets=()):
+        message = {'type': 'samples', 'resets': list(resets), 'samples': samples}
+        with self.lock:
+            for client in self.clients:
+                try:
+                    client.queue.put_nowait(message)
+                except queue.Full:
+                    self.logger.error(f'collector {client.address} does not keep up, disconnect')
+                    client.close()
+
+    def send_loop(self, client):
+        try:
+            while not client.closed:
+                try:
+                    message = client.queue.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+                send_message(client.sock, message)
+        except OSError as ex:
+            self.logger.error(f'collector {client.address} send error: {ex}')
+        finally:
+            client.close()
+            with self.lock:
+                if client in self.clients:
+                    self.clients.remove(client)
+            client.sock.close()
+            self.logger.info(f'collector disconnected: {client.address}')
+
+    def receive_loop(self, client):
+        buffer = b''
+        try:
+            while not client.closed:
+                try:
+                    messages, buffer = read_messages(client.sock, buffer)
+                except socket.timeout:
+                    continue
+                for message in messages:
+                    if message.get('type') == 'ping':
+                        client.queue.put_nowait({'type': 'pong', 't': message['t'], 'server_time': time.time()})
+        except (OSError, ValueError, queue.Full):
+            client.close()
+
+
+class GatewayConnection(threading.Thread):
+    """Receives sample batches of one gateway, reconnects on errors without affecting other gateways."""
+
+    connect_timeout = 5.0
+    receive_timeout = 1.0
+    sync_period = 60.0
+    reconnect_period = 10.0
+
+    def __init__(self, host, port, first_index, sensors, samples):
+        super().__init__(daemon=True)
+        self.logger = logging.getLogger(f'manager.collector.{host}:{port}')
+        self.host = host
+        self.port = port
+        self.first_index = first_index
+        self.sensors = sensors
+        self.samples = samples
+        self.offset = 0.0
+        self.__run = True
+
+    def stop(self):
+        self.__run = False
+
+    def run(self):
+        while self.__run:
+            try:
+                self.receive()
+            except (OSError, ValueError) as ex:
+                self.logger.error(f'gateway error: {ex}')
+            if self.__run:
+                time.sleep(self.reconnect_period)
+
+    def receive(self):
+        with socket.create_connection((self.host, self.port), timeout=self.connect_timeout) as sock:
+            self.logger.info('gateway connected')
+            sock.settimeout(self.receive_timeout)
+            buffer = b''
+            last_sync = 0.0
+            while self.__run:
+                if time.time() - last_sync > self.sync_period:
+                    send_message(sock, {'type': 'ping', 't': time.time()})
+                    last_sync = time.time()
+                try:
+                    messages, buffer = read_messages(sock, buffer)
+                except socket.timeout:
+                    continue
+                for message in messages:
+                    self.handle(message)
+
+    def handle(self, message):
+        if message['type'] == 'hello':
+            if message['sensors'] != self.sensors:
+                self.logger.error(f'gateway has {message["sensors"]} sensors, {self.sensors} configured')
+        elif message['type'] == 'pong':
+            # clock offset of the gateway assuming a symmetric round trip
+            self.offset = message['server_time'] - (message['t'] + time.time()) / 2
+            self.logger.debug(f'gateway clock offset {round(self.offset, 3)} sec')
+        elif message['type'] == 'samples':
+            resets = [self.first_index + index for index in message.get('resets', []) if index < self.sensors]
+            batch = []
+            for index, ts, temperature, voltage, current in message['samples']:
+                if index >= self.sensors:
+                    continue
+                batch.append((self.first_index + index, {
+                    # sample times are naive and sent as if they were UTC, see encode_sample
+                    'dtime': datetime.fromtimestamp(ts - self.offset, timezone.utc).replace(tzinfo=None),
+                    'temperature': math.nan if temperature is None else temperature,
+                    'voltage': voltage,
+                    'current': current,
+                }))
+            self.samples.put((resets, batch))
+
+
+class FederationCollector:
+    """Merges the sample streams of several gateways into one DataProcessor."""
+
+    poll_period = 0.5
+
+    def __init__(self, gateways):
+        self.samples = queue.Queue()
+        self.connections = []
+        self.number = 0
+        for host, port, sensors in gateways:
+            self.connections.append(GatewayConnection(host, port, self.number, sensors, self.samples))
+            self.number += sensors
+
+    @staticmethod
+    def parse(value):
+        # host:port/sensors, ...
+        gateways = []
+        for item in value.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            address, _, sensors = item.partition('/')
+            host, _, port = address.rpartition(':')
+            gateways.append((host, int(port), int(sensors or 8)))
+        return gateways
+
+    def start(self):
+        for connection in self.connections:
+            connection.start()
+
+    def stop(self):
+        for connection in self.connections:
+            connection.stop()
+
+    def collect(self, data_processor):
+        samples = []
+        changed = set()
+        while True:
+            try:
+                resets, batch = self.samples.get_nowait()
+            except queue.Empty:
+                break
+            if resets:
+                # the samples received before a reset are added before it
+                data_processor.add_samples(samples)
+                samples = []
+                for i in resets:
+                    data_processor.reset(i)
+                changed.update(resets)
+            samples.extend(batch)
+            changed.update(i for i, _ in batch)
+        data_processor.add_samples(samples)
+        return sorted(changed)
@@ -1,23 +1,31 @@
+import argparse
 import configparser
 import logging
+import logging.config
+import signal
 import sys
 import threading
 import time
 import traceback
 import os
+import queue
+from datetime import datetime
 
-from PyQt5.QtCore import QObject, pyqtSignal
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
 from PyQt5.QtWidgets import QApplication, QMessageBox
 
+from acquisition import AcquisitionProcess
 from data_processor import DataProcessor
-from data_reader import DataReader
-# from data_reader import SimDataReader as DataReader
+from data_reader import DataReader, Recording, create_readers, read_addresses, read_samples
+from federation import FederationCollector, GatewayServer, encode_sample
+from profiler import Profiler
 from ui import MainWindow
 from plot import Plot, BigPlot, PlotProperties
 
 
 class DataManager(QObject):
-    data_changed = pyqtSignal(list)
+    data_appended = pyqtSignal(int, int, object)
+    data_reset = pyqtSignal(int, int)
     data_address_changed = pyqtSignal(int, str)
 
     def __init__(self, number=8, *args, **kwargs):
@@ -25,73 +33,220 @@ class DataManager(QObject):
         super().__init__(*args, **kwargs)
         config = configparser.ConfigParser()
         config.read('config.ini')
-        addresses = [config.get('DataReader', f'bt_{i + 1}') or None for i in range(number)]
-        self.data_readers = [DataReader(i, address=addr) for i, addr in zip(range(number), addresses)]
-        self.data_processor = DataProcessor(number)
+        # samples come from a child process or from remote gateways instead of the local readers
+        self.source = None
+        gateways = FederationCollector.parse(config.get('Federation', 'gateways', fallback=''))
+        if gateways:
+            self.source = FederationCollector(gateways)
+            number = self.source.number
+        acquisition_process = not gateways and config.getboolean('DataReader', 'acquisition_process', fallback=False)
+        self.replay = not gateways and config.get('DataReader', 'reader', fallback='bluetooth') == 'replay'
+        self.data_readers, self.recording = [], None
+        if acquisition_process:
+            # the child reads the devices or the recording, here the readers only keep the addresses
+            self.data_readers = [DataReader(i, address) for i, address in enumerate(read_addresses(config, number))]
+        elif not gateways:
+            self.data_readers, self.recording = create_readers(config, number)
+        self.period = float(config.get('DataReader', f'period'))
+        if self.replay:
+            self.period = Recording.scale_period(self.period, config.getfloat('Replay', 'speed', fallback=1.0))
+        if gateways:
+            # every gateway maps the temperatures of its own packs before publishing
+            temperature_sources = [None] * number
+        else:
+            temperature_sources = [self.temperature_source(config, i, number) for i in range(number)]
+        if acquisition_process:
+            self.source = AcquisitionProcess(number, self.period, temperature_sources,
+                                             log_config=acquisition_logger_config())
+        self.data_processor = DataProcessor(
+            number, persist=self.source is None and not self.replay,
+            temperature_sources=temperature_sources, history=not gateways)
+        self.gateway = None
+        serve_port = config.get('Federation', 'serve_port', fallback='')
+        if serve_port:
+            self.gateway = GatewayServer(int(serve_port), number)
+        if self.replay:
+            self.data_processor.clear()
         self.plots = [Plot() for _ in range(number)]
         self.big_plot = BigPlot()
+        self.big_plot.data_processor = self.data_processor
         self.plot_properties = PlotProperties()
         self.big_plot_number = None
-        self.period = float(config.get('DataReader', f'period'))
+        self.max_voltage_diff = config.getfloat('Report', 'max_voltage_diff', fallback=0.0)
+        self.spread_checked = None
+        # a cycle is slow when it takes longer than the loop period, 0 disables the check
+        slow_cycle = config.get('Profiler', 'slow_cycle', fallback='')
+        self.profiler = Profiler(
+            slow_cycle=float(slow_cycle) if slow_cycle else (
+                self.period if self.source is None else self.source.poll_period),
+            slow_draw=config.getfloat('Profiler', 'slow_draw', fallback=1.0),
+            snapshot_period=config.getfloat('Profiler', 'snapshot_period', fallback=0.0))
+        # requests of the GUI thread, applied by the loop thread before its next cycle
+        self.requests = queue.Queue()
+        self.wakeup = threading.Event()
         self.__run = True
 
+    def temperature_source(self, config, index, number):
+        value = config.get('DataProcessor', f'temperature_source_{index + 1}', fallback='1' if index else '')
+        if not value:
+            return None
+        try:
+            source = int(value) - 1
+        except ValueError:
+            source = -1
+        if not 0 <= source < number:
+            self.logger.error(f'temperature_source_{index + 1} = {value} is not a sensor number 1..{number}, ignored')
+            return None
+        return source
+
     def start(self):
         for r in self.data_readers:
             self.data_address_changed.emit(r.number, r.address)
+        if self.source is not None:
+            self.source.start()
+        if self.gateway is not None:
+            self.gateway.start()
         threading.Thread(target=self.loop).start()
 
     def stop(self):
         self.__run = False
+        self.wakeup.set()
 
     def loop(self):
+        period = self.period if self.source is None else self.source.poll_period
         while self.__run:
             t0 = time.time()
-            self.update()
-            sleep_timeout = self.period - (time.time() - t0)
+            self.wakeup.clear()
+            with self.profiler.cycle():
+                self.update()
+            sleep_timeout = period - (time.time() - t0)
+            if self.recording is not None and self.recording.finished():
+                # nothing left to replay until a seek
+                sleep_timeout = max(sleep_timeout, self.recording.idle_period)
             if sleep_timeout > 0:
-                time.sleep(sleep_timeout)
+                self.wakeup.wait(sleep_timeout)
+        if self.source is not None:
+            self.source.stop()
+        if self.gateway is not None:
+            self.gateway.stop()
+        for data_reader in self.data_readers:
+            if hasattr(data_reader, 'close'):
+                data_reader.close()
 
     def update(self):
-        self.data_processor.begin_circle()
-        t0 = time.time()
-        self.logger.debug('start read')
-        for i, data_reader in enumerate(self.data_readers):
-            try:
-                data = data_reader.read()
-            except Exception as ex:
-                data = None
-            if data:
-                self.data_processor.add_data(i, data)
-        self.logger.debug(f'end read {round(time.time() - t0, 3)} sec')
-        self.data_processor.end_circle()
+        self.apply_requests()
+        with self.profiler.stage('read'):
+            if self.source is not None:
+                self.source.collect(self.data_processor)
+            else:
+                self.read()
+        with self.profiler.stage('report'):
+            self.check_spread()
+        with self.profiler.stage('drain'):
+            events = self.data_processor.drain_events()
+        self.process_events(events)
 
+    def process_events(self, events):
+        if not events:
+            return
+        if self.gateway is not None:
+            with self.profiler.stage('publish'):
+                # a reset is followed by an append of the whole frame, the collectors reset the sensor too
+                self.gateway.publish([encode_sample(i, row) for kind, i, _, rows in events if kind == 'append'
+                                      for _, row in rows.iterrows()],
+                                     resets=[i for kind, i, _, _ in events if kind == 'reset'])
+
+        changed = sorted({i for _, i, _, _ in events})
         t0 = time.time()
-        self.logger.debug('update plots')
-        for i, df, plot in zip(range(len(self.data_processor.dfs)), self.data_processor.dfs, self.plots):
-            if df is not None and not df.empty:
-                plot.create_plot(df, f'{i + 1}', self.plot_properties)
+        self.logger.debug(f'update plots {changed}')
+        with self.profiler.stage('plots'):
+            for i in changed:
+                data = self.data_processor.query(i, max_points=self.plots[i].max_points)
+                if len(data['dtime']):
+                    self.plots[i].create_plot(data, f'{i + 1}', self.plot_properties)
         self.logger.debug(f'end update plots {round(time.time() - t0, 3)} sec')
-        if self.big_plot_number is not None:
-            self.update_big_plot(self.big_plot_number)
+        if self.big_plot_number in changed:
+            with self.profiler.stage('big_plot'):
+                self.update_big_plot(self.big_plot_number)
+
+        with self.profiler.stage('emit'):
+            for kind, i, seq, payload in events:
+                if kind == 'append':
+                    self.data_appended.emit(i, seq, payload)
+                elif kind == 'reset':
+                    self.data_reset.emit(i, seq)
 
-        self.data_changed.emit(self.data_processor.dfs)
+    def check_spread(self):
+        # voltage spread across all packs in the cycles since the previous check
+        times, spread = self.data_processor.store.spread('voltage', self.spread_checked)
+        if not len(times):
+            return
+        self.spread_checked = times[-1]
+        if not self.max_voltage_diff:
+            return
+        over = spread > self.max_voltage_diff
+        for dtime, value in zip(times[over], spread[over]):
+            self.logger.warning(f'voltage spread {round(value, 3)} V at {dtime.astype("datetime64[s]")} '
+                                f'is over {self.max_voltage_diff} V')
+
+    def read(self):
+        t0 = time.time()
+        self.logger.debug('start read')
+        samples = read_samples(self.data_readers, self.recording, self.logger)
+        self.logger.debug(f'end read {round(time.time() - t0, 3)} sec')
+        self.data_processor.add_samples(samples, self.recording.now() if self.recording is not None else None)
 
     def change_address(self, index, address):
+        if index >= len(self.data_readers):
+            return
         self.data_readers[index].set_address(address)
+        if isinstance(self.source, AcquisitionProcess):
+            self.source.set_address(index, address)
         self.data_address_changed.emit(index, address)
         self.save_address()
 
     def update_big_plot(self, number):
         self.logger.debug(f'update_big_plot #{number}')
         self.big_plot_number = number
-        df = self.data_processor.dfs[self.big_plot_number]
-        if self.big_plot_number is not None and not df.empty:
-            self.big_plot.create_plot(df, str(self.big_plot_number + 1), self.plot_properties)
+        self.big_plot.number = number
+        data = self.data_processor.query(number, max_points=self.big_plot.max_points)
+        if len(data['dtime']):
+            self.big_plot.create_plot(data, str(number + 1), self.plot_properties)
+
+    def apply_requests(self):
+        while True:
+            try:
+                request, *args = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            if request == 'reset':
+                self.data_processor.reset(*args)
+                if isinstance(self.source, AcquisitionProcess):
+                    self.source.reset(*args)
+            elif request == 'seek':
+                if isinstance(self.source, AcquisitionProcess):
+                    self.source.seek(*args)
+                else:
+                    self.recording.seek(*args)
+                self.data_processor.clear()
+                self.spread_checked = None
 
     def reset_plot(self, index):
         self.logger.debug(f'reset plot index: {index}')
-        self.data_processor.reset(index)
-        self.data_changed.emit(self.data_processor.dfs)
+        self.requests.put(('reset', index))
+        self.wakeup.set()
+
+    def seek(self, dtime):
+        if not self.replay:
+            return
+        try:
+            dtime = datetime.fromisoformat(dtime.strip()) if isinstance(dtime, str) else dtime
+        except ValueError:
+            self.logger.error(f'bad replay seek time: {dtime}')
+            return
+        self.logger.info(f'replay seek to {dtime}')
+        self.requests.put(('seek', dtime))
+        self.wakeup.set()
 
     def save_address(self):
         config = configparser.ConfigParser()
@@ -105,20 +260,43 @@ class DataManager(QObject):
 
 
 def main():
+    args = parse_args()
     logger_init()
     check_config()
     app = QApplication([])
     data_manager = DataManager()
+    if args.profile:
+        data_manager.profiler.request_profile(args.profile)
+    if args.memory_snapshot_period is not None:
+        data_manager.profiler.snapshot_period = args.memory_snapshot_period
+        data_manager.profiler.request_snapshot()
+    if args.slow_cycle is not None:
+        data_manager.profiler.slow_cycle = args.slow_cycle
+    # SIGUSR1 profiles the next cycles, SIGUSR2 takes a memory snapshot
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda *_: data_manager.profiler.request_profile(args.profile or 10))
+        signal.signal(signal.SIGUSR2, lambda *_: data_manager.profiler.request_snapshot())
+        # let the interpreter run the signal handlers while Qt is in its event loop
+        signal_timer = QTimer()
+        signal_timer.timeout.connect(lambda: None)
+        signal_timer.start(500)
 
     main_win = MainWindow()
-    main_win.init(data_manager.plots, data_manager.big_plot, data_manager.plot_properties)
+    main_win.init(data_manager.plots, data_manager.big_plot, data_manager.plot_properties, data_manager.profiler,
+                  replay=data_manager.replay)
+    if args.seek:
+        data_manager.seek(args.seek)
 
-    data_manager.data_changed.connect(main_win.change_plots)
-    data_manager.data_changed.connect(main_win.draw_big_plot)
+    data_manager.data_appended.connect(main_win.on_data_appended)
+    data_manager.data_reset.connect(main_win.on_data_reset)
     data_manager.data_address_changed.connect(main_win.on_data_address_changed)
     main_win.create_big_plot.connect(data_manager.update_big_plot)
     main_win.reset_plot.connect(data_manager.reset_plot)
     main_win.change_data_address.connect(data_manager.change_address)
+    main_win.profile_cycles.connect(data_manager.profiler.request_profile)
+    main_win.memory_snapshot.connect(data_manager.profiler.request_snapshot)
+    main_win.seek_replay.connect(data_manager.seek)
+    main_win.edit_address.setEnabled(bool(data_manager.data_readers))
     main_win.show()
 
     data_manager.start()
@@ -133,6 +311,19 @@ def main():
         msg.exec_()
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='Battery monitor')
+    parser.add_argument('--profile', type=int, default=0, metavar='CYCLES',
+                        help='save cProfile stats of the first CYCLES poll cycles to the profiles folder')
+    parser.add_argument('--memory-snapshot-period', type=float, default=None, metavar='SEC',
+                        help='take tracemalloc snapshots every SEC seconds')
+    parser.add_argument('--slow-cycle', type=float, default=None, metavar='SEC',
+                        help='log poll cycles longer than SEC seconds with a per-stage breakdown')
+    parser.add_argument('--seek', default='', metavar='TIME',
+                        help='start the replay at TIME (YYYY-MM-DD HH:MM:SS)')
+    return parser.parse_args()
+
+
 def check_config():
     config = configparser.ConfigParser()
     if not config.read('config.ini'):
@@ -146,13 +337,47 @@ def check_config():
         config['Plot'] = {}
         config['DataReader'] = {
             **{f'bt_{i}': '' for i in range(1, 10)},
-            'period': '60.0'}
+            'period': '60.0',
+            'acquisition_process': 'no',
+            'reader': 'bluetooth'}
+        config['Replay'] = {
+            'path': 'replay',
+            'speed': '1.0',
+            'start': ''}
+        config['Federation'] = {
+            'serve_port': '',
+            'gateways': ''}
+        config['Profiler'] = {
+            'slow_cycle': '',
+            'slow_draw': '1.0',
+            'snapshot_period': '0'}
+        config['DataProcessor'] = {
+            f'temperature_source_{i}': '' if i == 1 else '1' for i in range(1, 10)}
         with open('config.ini', 'w') as f:
             config.write(f)
     return config.read('config.ini')
 
 
 def logger_init():
+    if not os.path.exists('logs'):
+        os.mkdir('logs')
+    logging.config.dictConfig(logger_config())
+
+
+def acquisition_logger_config():
+    # the child process writes to its own file, two processes must not rotate the same one
+    logconfig = logger_config()
+    logconfig['handlers'] = {
+        'console': logconfig['handlers']['console'],
+        'acquisition': {**logconfig['handlers']['data_reader'], 'filename': 'logs/acquisition.log'},
+    }
+    logconfig['loggers'] = {
+        name: {'handlers': ['console', 'acquisition'], 'level': 'DEBUG'} for name in ('acquisition', 'data_reader')
+    }
+    return logconfig
+
+
+def logger_config():
     logconfig = {
         'version': 1,
         'handlers': {
@@ -210,9 +435,7 @@ def logger_init():
             }
         }
     }
-    if not os.path.exists('logs'):
-        os.mkdir('logs')
-    logging.config.dictConfig(logconfig)
+    return logconfig
 
 
 if __name__ == '__main__':
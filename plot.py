@@ -1,5 +1,4 @@
 import pandas as pd
-import numpy as np
 import matplotlib.dates as mdates
 from matplotlib.ticker import AutoMinorLocator, MaxNLocator, NullLocator, FixedLocator,  EngFormatter, LinearLocator
 from matplotlib import rcParams
@@ -25,6 +24,8 @@ class PlotProperties:
 
 
 class Plot:
+    max_points = 2000
+
     def __init__(self):
         self.df = None
         self.ax1 = None
@@ -113,7 +114,7 @@ class Plot:
         # if plot_properties.show_extra_pen:
         #     self.ax3.set_xlim(0, 100)
 
-        x_min, x_max = df['dtime'].iloc[[0, -1]].values
+        x_min, x_max = df['dtime'][[0, -1]]
         for ax in (self.ax1, self.ax2, self.ax3, self.ax4):
             ax.set_xlim(x_min, x_max)
 
@@ -142,10 +143,13 @@ class Plot:
 
 
 class BigPlot(Plot):
+    max_points = None
 
     def __init__(self):
         super(BigPlot, self).__init__()
         self.text_integral = None
+        self.data_processor = None
+        self.number = None
 
     def set_data(self, df, plot_properties):
         p12, p15, p16 = super(BigPlot, self).set_data(df, plot_properties)
@@ -183,7 +187,7 @@ class BigPlot(Plot):
         self.ax4.set_ylim(*self.current_limits)
         self.ax3.set_xlim(0, 100)
 
-        x_min, x_max = df['dtime'].iloc[[0, -1]].values
+        x_min, x_max = df['dtime'][[0, -1]]
         self.ax1.set_xlim(x_min, x_max)
         self.ax2.set_xlim(x_min, x_max)
         self.ax4.set_xlim(x_min, x_max)
@@ -210,12 +214,11 @@ class BigPlot(Plot):
         tz = timezone(zone='UTC')
         tmin = datetime.fromtimestamp(xmin * 24 * 3600, tz=tz)
         tmax = datetime.fromtimestamp(xmax * 24 * 3600, tz=tz)
-        df = self.df[(self.df['dtime'] > np.datetime64(tmin)) & (self.df['dtime'] < np.datetime64(tmax))]
-        if not df.empty:
-            integral = np.trapz(df['current'], x=df['dtime']) * (0.1 ** 9)
-            integral_a_h = round(float(integral) / 3600, 3)
-            x = df['dtime'].values[0]
-            y = df['current'].values.max() + 1.0
+        df = self.data_processor.query(self.number, tmin, tmax, ['current'])
+        if len(df['dtime']):
+            integral_a_h = round(self.data_processor.integral(self.number, tmin, tmax), 3)
+            x = df['dtime'][0]
+            y = df['current'].max() + 1.0
             text = f'{integral_a_h} А∙ч'
             if not self.text_integral:
                 self.text_integral = self.ax4.text(
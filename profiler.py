@@ -0,0 +1,140 @@
+import cProfile
+import io
+import logging
+import logging.handlers
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class Profiler:
+    """On-demand profiling of the polling loop.
+
+    cProfile stats of the next N cycles, tracemalloc snapshots compared with the previous one
+    and slow cycles with a per-stage breakdown are written as timestamped files to path.
+    """
+
+    top = 40
+    slow_cycles_max_bytes = 1024 * 1024
+    slow_cycles_backup_count = 5
+
+    def __init__(self, path='profiles', slow_cycle=0.0, slow_draw=1.0, snapshot_period=0.0):
+        self.logger = logging.getLogger('manager.profiler')
+        self.path = path
+        self.slow_cycle = slow_cycle
+        self.slow_draw = slow_draw
+        self.snapshot_period = snapshot_period
+        self.requested_cycles = 0
+        self.requested_snapshot = False
+        self.profile = None
+        self.cycles_left = 0
+        self.cycle_thread = None
+        self.stages = []
+        self.last_snapshot = None
+        self.last_snapshot_time = time.time()
+        self.lock = threading.Lock()
+        self.slow_cycles_logger = None
+
+    def request_profile(self, cycles):
+        self.logger.info(f'profile of {cycles} cycles requested')
+        self.requested_cycles = cycles
+
+    def request_snapshot(self):
+        self.logger.info('memory snapshot requested')
+        self.requested_snapshot = True
+
+    def file_name(self, prefix, extension):
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+        return os.path.join(self.path, f'{prefix}_{datetime.now().strftime("%Y%m%d_%H%M%S_%f")}.{extension}')
+
+    @contextmanager
+    def cycle(self):
+        if self.requested_cycles and self.profile is None:
+            self.cycles_left, self.requested_cycles = self.requested_cycles, 0
+            self.profile = cProfile.Profile()
+        self.cycle_thread = threading.get_ident()
+        self.stages = []
+        t0 = time.time()
+        if self.profile is not None:
+            self.profile.enable()
+        try:
+            yield
+        finally:
+            if self.profile is not None:
+                self.profile.disable()
+                self.cycles_left -= 1
+                if self.cycles_left <= 0:
+                    self.dump_profile()
+            duration = time.time() - t0
+            if self.slow_cycle and duration > self.slow_cycle:
+                self.report_slow_cycle(duration)
+            if self.requested_snapshot or (
+                    self.snapshot_period and time.time() - self.last_snapshot_time > self.snapshot_period):
+                self.snapshot()
+
+    @contextmanager
+    def stage(self, name):
+        if threading.get_ident() != self.cycle_thread:
+            yield
+            return
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.time() - t0))
+
+    def report_draw(self, name, duration):
+        if self.slow_draw and duration > self.slow_draw:
+            self.logger.warning(f'slow draw {name}: {round(duration, 3)} sec')
+
+    def report_slow_cycle(self, duration):
+        stages = ', '.join(f'{name} {round(d, 3)}' for name, d in self.stages)
+        self.logger.warning(f'slow cycle {round(duration, 3)} sec: {stages}')
+        if self.slow_cycles_logger is None:
+            if not os.path.exists(self.path):
+                os.mkdir(self.path)
+            handler = logging.handlers.RotatingFileHandler(
+                os.path.join(self.path, 'slow_cycles.txt'),
+                maxBytes=self.slow_cycles_max_bytes, backupCount=self.slow_cycles_backup_count)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            # not registered with logging, so every profiler writes to its own path only
+            self.slow_cycles_logger = logging.Logger('profiler.slow_cycles', logging.INFO)
+            self.slow_cycles_logger.addHandler(handler)
+        self.slow_cycles_logger.info(f'{round(duration, 3)} sec: {stages}')
+
+    def dump_profile(self):
+        file_name = self.file_name('cycles', 'prof')
+        self.profile.dump_stats(file_name)
+        text = io.StringIO()
+        pstats.Stats(self.profile, stream=text).sort_stats('cumulative').print_stats(self.top)
+        with open(file_name[:-len('prof')] + 'txt', 'w') as f:
+            f.write(text.getvalue())
+        self.profile = None
+        self.logger.info(f'profile saved to {file_name}')
+
+    def snapshot(self):
+        with self.lock:
+            self.requested_snapshot = False
+            self.last_snapshot_time = time.time()
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+                self.logger.info('tracemalloc started, the next snapshot will be compared with this one')
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+            ])
+            file_name = self.file_name('memory', 'snapshot')
+            snapshot.dump(file_name)
+            if self.last_snapshot is not None:
+                stats = snapshot.compare_to(self.last_snapshot, 'lineno')
+            else:
+                stats = snapshot.statistics('lineno')
+            with open(file_name[:-len('snapshot')] + 'txt', 'w') as f:
+                for stat in stats[:self.top]:
+                    f.write(f'{stat}\n')
+            self.last_snapshot = snapshot
+            self.logger.info(f'memory snapshot saved to {file_name}, traced: {tracemalloc.get_traced_memory()}')
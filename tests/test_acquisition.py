@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from acquisition import SharedRingBuffer
+
+
+@pytest.fixture
+def buffer():
+    buffer = SharedRingBuffer(capacity=4, create=True)
+    yield buffer
+    buffer.close(unlink=True)
+
+
+def rows(start, count):
+    return [[i, i + 0.1, i + 0.2, i + 0.3] for i in range(start, start + count)]
+
+
+def test_read_new_rows(buffer):
+    buffer.write(rows(0, 3))
+    total, data = buffer.read(1)
+    assert total == 3
+    np.testing.assert_array_equal(data, rows(1, 2))
+
+
+def test_wraparound(buffer):
+    buffer.write(rows(0, 3))
+    buffer.write(rows(3, 3))
+    total, data = buffer.read(3)
+    assert total == 6
+    np.testing.assert_array_equal(data, rows(3, 3))
+
+
+def test_overrun_keeps_latest_rows(buffer):
+    buffer.write(rows(0, 2))
+    buffer.write(rows(2, 7))
+    total, data = buffer.read(0)
+    assert total == 9
+    np.testing.assert_array_equal(data, rows(5, 4))
+
+
+def test_reader_attaches_by_name(buffer):
+    reader = SharedRingBuffer(buffer.name, capacity=4)
+    try:
+        buffer.write(rows(0, 5))
+        total, data = reader.read(0)
+        assert total == 5
+        np.testing.assert_array_equal(data, rows(1, 4))
+    finally:
+        reader.close()
+
+
+def test_interrupted_write_does_not_hang(buffer, monkeypatch):
+    monkeypatch.setattr(buffer, 'read_timeout', 0.05)
+    buffer.write(rows(0, 2))
+    # a writer that died between the two counter increments
+    buffer.header[0] += 1
+    with pytest.raises(TimeoutError):
+        buffer.read(0)
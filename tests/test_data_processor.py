@@ -0,0 +1,184 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from data_processor import AlignedStore, DataProcessor
+
+
+@pytest.fixture
+def data_processor(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return DataProcessor(2, persist=False)
+
+
+def sample(dtime, temperature=20.0):
+    return {'dtime': dtime, 'temperature': temperature, 'voltage': 12.5, 'current': 1.0}
+
+
+def test_append_events(data_processor):
+    t = datetime(2026, 1, 1)
+    data_processor.add_samples([(0, sample(t)), (0, sample(t + timedelta(seconds=1))), (1, sample(t))])
+    events = data_processor.drain_events()
+    assert [(kind, idx, len(payload)) for kind, idx, _, payload in events] == [('append', 0, 2), ('append', 1, 1)]
+    assert [seq for _, _, seq, _ in events] == [1, 2]
+    assert data_processor.drain_events() == []
+
+
+def test_truncate_events(data_processor):
+    t = datetime(2026, 1, 1)
+    data_processor.add_batch(0, [sample(t), sample(t + timedelta(hours=1))])
+    data_processor.drain_events()
+    data_processor.add_batch(0, [sample(t + timedelta(hours=12, minutes=30))])
+    events = data_processor.drain_events()
+    assert [(kind, idx) for kind, idx, _, _ in events] == [('truncate', 0), ('append', 0)]
+    assert events[0][3] == 1
+    assert len(events[1][3]) == 1
+    assert len(data_processor.dfs[0]) == 2
+
+
+def test_truncate_of_undrained_rows(data_processor):
+    t = datetime(2026, 1, 1)
+    data_processor.add_batch(0, [sample(t)])
+    data_processor.add_batch(0, [sample(t + timedelta(hours=13))])
+    # the first row was never announced, so it is neither appended nor truncated
+    events = data_processor.drain_events()
+    assert [(kind, idx) for kind, idx, _, _ in events] == [('append', 0)]
+    assert len(events[0][3]) == 1
+
+
+def test_out_of_order_samples_reset(data_processor):
+    t = datetime(2026, 1, 1)
+    data_processor.add_batch(0, [sample(t + timedelta(seconds=10))])
+    data_processor.drain_events()
+    data_processor.add_batch(0, [sample(t)])
+    events = data_processor.drain_events()
+    assert [(kind, idx) for kind, idx, _, _ in events] == [('reset', 0), ('append', 0)]
+    assert list(events[1][3]['dtime']) == [t, t + timedelta(seconds=10)]
+    assert np.all(np.diff(data_processor.times[0]) > 0)
+
+
+def test_reset_drops_pending_rows(data_processor):
+    data_processor.add_batch(1, [sample(datetime(2026, 1, 1))])
+    data_processor.reset(1)
+    events = data_processor.drain_events()
+    assert [(kind, idx) for kind, idx, _, _ in events] == [('reset', 1)]
+    assert data_processor.dfs[1].empty
+
+
+def test_store_late_sample_goes_to_its_cycle():
+    t = datetime(2026, 1, 1)
+    store = AlignedStore(2, capacity=1)
+    store.begin_cycle(t)
+    store.begin_cycle(t + timedelta(seconds=10))
+    assert store.put(1, t + timedelta(seconds=5), sample(t, 21.0))
+    assert not store.put(1, t - timedelta(seconds=5), sample(t, 22.0))
+    assert store.channel('temperature')[0, 1] == 21.0
+    assert np.isnan(store.channel('temperature')[1, 1])
+
+
+def test_store_late_cycle_keeps_times_sorted():
+    t = datetime(2026, 1, 1)
+    store = AlignedStore(1)
+    store.begin_cycle(t + timedelta(seconds=10))
+    store.begin_cycle(t)
+    assert store.size == 2
+    assert store.times[0] == store.times[1]
+
+
+def test_store_spread():
+    t = datetime(2026, 1, 1)
+    store = AlignedStore(3)
+    for k, voltages in enumerate([[12.0, 12.5, None], [None, None, None], [13.0, 12.0, 12.2]]):
+        store.begin_cycle(t + timedelta(seconds=k))
+        for sensor, voltage in enumerate(voltages):
+            if voltage is not None:
+                store.put(sensor, t + timedelta(seconds=k), {'voltage': voltage})
+    times, spread = store.spread('voltage')
+    assert len(times) == 3
+    np.testing.assert_allclose(spread, [0.5, np.nan, 1.0])
+    times, spread = store.spread('voltage', t + timedelta(seconds=1))
+    assert list(times) == [np.datetime64(t + timedelta(seconds=2), 'ns')]
+    np.testing.assert_allclose(spread, [1.0])
+
+
+def test_store_trim():
+    t = datetime(2026, 1, 1)
+    store = AlignedStore(1)
+    for k in range(4):
+        store.begin_cycle(t + timedelta(hours=k))
+        store.put(0, t + timedelta(hours=k), {'voltage': float(k)})
+    store.trim(np.datetime64(t + timedelta(hours=1)))
+    assert store.size == 2
+    assert store.channel('voltage')[:, 0].tolist() == [2.0, 3.0]
+
+
+def test_store_save_load(tmp_path):
+    t = datetime(2026, 1, 1)
+    store = AlignedStore(2)
+    store.begin_cycle(t)
+    store.put(0, t, sample(t))
+    path = str(tmp_path / 'store.npz')
+    store.save(path)
+    loaded = AlignedStore(2)
+    loaded.load(path)
+    assert loaded.size == 1
+    assert loaded.times[0] == np.datetime64(t, 'ns')
+    np.testing.assert_array_equal(loaded.values[:1], store.values[:1])
+    # a store of another sensor count is not loaded
+    other = AlignedStore(3)
+    other.load(path)
+    assert other.size == 0
+
+
+def test_corrupt_store_is_ignored(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data').mkdir()
+    (tmp_path / 'data' / 'store.npz').write_bytes(b'PK\x03\x04 broken')
+    assert DataProcessor(2, persist=False).store.size == 0
+
+
+def test_temperature_source_mapping(data_processor):
+    t = datetime(2026, 1, 1)
+    data_processor.add_samples([(0, sample(t, 30.0)), (1, sample(t, -70.0))])
+    assert data_processor.dfs[1]['temperature'].tolist() == [30.0]
+    assert data_processor.store.last('temperature').tolist() == [30.0, 30.0]
+
+
+def test_query_bounds(data_processor):
+    t = datetime(2026, 1, 1)
+    data_processor.add_batch(0, [sample(t + timedelta(seconds=k), float(k)) for k in range(10)])
+    data = data_processor.query(0, t + timedelta(seconds=2), t + timedelta(seconds=5), ['temperature'])
+    assert data['temperature'].tolist() == [2.0, 3.0, 4.0, 5.0]
+    assert list(data) == ['dtime', 'temperature']
+    data = data_processor.query(0, t + timedelta(seconds=2.5), t + timedelta(seconds=3.5), ['temperature'])
+    assert data['temperature'].tolist() == [3.0]
+    assert len(data_processor.query(0, t + timedelta(seconds=20))['dtime']) == 0
+    assert len(data_processor.query(1)['dtime']) == 0
+
+
+def test_query_max_points_keeps_the_ends(data_processor):
+    t = datetime(2026, 1, 1)
+    data_processor.add_batch(0, [sample(t + timedelta(seconds=k), float(k)) for k in range(2002)])
+    data = data_processor.query(0, fields=['temperature'], max_points=2000)
+    assert len(data['dtime']) == 2000
+    assert data['temperature'][0] == 0.0
+    assert data['temperature'][-1] == 2001.0
+    assert np.all(np.diff(data['temperature']) > 0)
+
+
+def test_integral(data_processor):
+    t = datetime(2026, 1, 1)
+    data_processor.add_batch(0, [
+        {'dtime': t + timedelta(hours=k), 'temperature': 20.0, 'voltage': 12.0, 'current': float(k)}
+        for k in range(3)])
+    assert data_processor.integral(0, t, t + timedelta(hours=2)) == pytest.approx(2.0)
+    assert data_processor.integral(0, t, t + timedelta(hours=1)) == pytest.approx(0.5)
+    assert data_processor.integral(0, t + timedelta(minutes=30), t + timedelta(hours=1)) == 0.0
+
+
+def test_cycle_without_samples_adds_no_row(data_processor):
+    for _ in range(10):
+        data_processor.add_samples([], datetime(2026, 1, 1))
+    assert data_processor.store.size == 0
+    assert data_processor.drain_events() == []
@@ -0,0 +1,133 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from data_reader import Recording, StreamDataReader, StreamParser, read_samples
+
+
+def test_split_line():
+    parser = StreamParser()
+    received = datetime(2026, 1, 1)
+    assert parser.feed('t:21.5;v:12.', received) == []
+    samples = parser.feed('6;c:1.2\n', received + timedelta(seconds=1))
+    assert [(s['temperature'], s['voltage'], s['current']) for s in samples] == [(21.5, 12.6, 1.2)]
+    assert parser.buffer == ''
+
+
+def test_skips_replies_and_bad_lines():
+    parser = StreamParser()
+    samples = parser.feed('<start_stream>\r\ngarbage\nt:20;v:12;c:1\r\n\n')
+    assert [s['temperature'] for s in samples] == [20.0]
+
+
+def test_lines_spread_between_receive_times():
+    parser = StreamParser()
+    received = datetime(2026, 1, 1)
+    assert [s['dtime'] for s in parser.feed('t:1;v:12;c:1\n', received)] == [received]
+    samples = parser.feed('t:2;v:12;c:1\nt:3;v:12;c:1\n', received + timedelta(seconds=2))
+    assert [s['dtime'] for s in samples] == [received + timedelta(seconds=1), received + timedelta(seconds=2)]
+
+
+def test_first_chunk_uses_the_sample_interval():
+    parser = StreamParser()
+    received = datetime(2026, 1, 1)
+    samples = parser.feed('t:1;v:12;c:1\nt:2;v:12;c:1\nt:3;v:12;c:1\n', received)
+    interval = timedelta(seconds=StreamParser.sample_interval)
+    assert [s['dtime'] for s in samples] == [received - 2 * interval, received - interval, received]
+
+
+def test_stream_reader_survives_unexpected_errors():
+    reader = StreamDataReader(0, '00:11:22:33:44:55')
+    reader.reconnect_period = 0.01
+    calls = []
+
+    def receive(address):
+        calls.append(address)
+        if len(calls) == 1:
+            raise RuntimeError('unexpected')
+        reader.close()
+
+    reader.receive = receive
+    reader.read_batch()
+    reader.thread.join(timeout=5.0)
+    assert not reader.thread.is_alive()
+    assert len(calls) == 2
+
+
+class BatchReader:
+
+    def __init__(self, samples):
+        self.samples = samples
+
+    def read_batch(self):
+        samples, self.samples = self.samples, []
+        return samples
+
+
+class FailingReader:
+
+    def read(self):
+        raise OSError('no connection')
+
+
+def test_read_samples_skips_failing_readers():
+    sample = {'dtime': datetime(2026, 1, 1), 'temperature': 20.0, 'voltage': 12.0, 'current': 1.0}
+    samples = read_samples([FailingReader(), BatchReader([sample, sample])])
+    assert samples == [(1, sample), (1, sample)]
+
+
+@pytest.fixture
+def recording(tmp_path):
+    t = datetime(2026, 1, 1)
+    for i, count in enumerate([5, 3]):
+        pd.DataFrame({
+            'dtime': [t + timedelta(minutes=k) for k in range(count)],
+            'temperature': 20.0,
+            'voltage': 12.0,
+            'current': [float(k) for k in range(count)],
+        }).to_pickle(tmp_path / f'{i + 1}.pickle')
+    (tmp_path / '3.pickle').write_bytes(b'not a pickle')
+    return Recording(str(tmp_path), 4, speed=0, step=120.0)
+
+
+def test_recording_loads_missing_and_corrupt_files_empty(recording):
+    assert [len(times) for times in recording.times] == [5, 3, 0, 0]
+
+
+def test_recording_tick_replays_one_step(recording):
+    recording.tick()
+    assert [s['current'] for s in recording.next_batch(0)] == [0.0, 1.0]
+    assert [s['current'] for s in recording.next_batch(1)] == [0.0, 1.0]
+    assert recording.next_batch(0) == []
+    recording.tick()
+    assert [s['current'] for s in recording.next_batch(0)] == [2.0, 3.0]
+    assert recording.next_batch(1)[0]['dtime'] == datetime(2026, 1, 1, 0, 2)
+
+
+def test_recording_finished(recording):
+    for _ in range(3):
+        recording.tick()
+        recording.next_batch(0)
+        recording.next_batch(1)
+    assert recording.finished()
+    now = recording.now_value()
+    recording.tick()
+    assert recording.now_value() == now
+
+
+def test_recording_seek(recording):
+    recording.seek(datetime(2026, 1, 1, 0, 3))
+    assert recording.positions == [3, 3, 0, 0]
+    recording.tick()
+    assert [s['current'] for s in recording.next_batch(0)] == [3.0, 4.0]
+    assert recording.finished()
+    recording.seek('2026-01-01 00:00:00')
+    assert not recording.finished()
+    recording.tick()
+    assert [s['current'] for s in recording.next_batch(0)] == [0.0, 1.0]
+
+
+def test_scale_period():
+    assert Recording.scale_period(60.0, 10.0) == 6.0
+    assert Recording.scale_period(60.0, 0) == 0.0
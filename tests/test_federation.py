@@ -0,0 +1,77 @@
+import socket
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from data_processor import DataProcessor
+from federation import FederationCollector, GatewayServer, encode_sample
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def sample(dtime, current):
+    return {'dtime': pd.Timestamp(dtime), 'temperature': 20.0, 'voltage': 12.5, 'current': current}
+
+
+@pytest.fixture
+def gateway():
+    server = GatewayServer(0, 2, host='127.0.0.1')
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def collector(gateway):
+    # the first gateway is offline and must not delay the second one
+    collector = FederationCollector([('127.0.0.1', free_port(), 2),
+                                     ('127.0.0.1', gateway.server.getsockname()[1], 2)])
+    collector.start()
+    assert wait_for(lambda: gateway.clients)
+    yield collector
+    collector.stop()
+
+
+def collect_until(collector, data_processor, condition):
+    def poll():
+        collector.collect(data_processor)
+        return condition()
+    return wait_for(poll)
+
+
+def test_samples_round_trip(gateway, collector):
+    data_processor = DataProcessor(collector.number, persist=False, history=False)
+    t = datetime(2026, 1, 1)
+    gateway.publish([encode_sample(0, sample(t, 1.0)), encode_sample(1, sample(t + timedelta(seconds=1), 2.0))])
+    assert collect_until(collector, data_processor, lambda: len(data_processor.dfs[3]))
+    assert data_processor.dfs[2]['current'].tolist() == [1.0]
+    # corrected by the measured clock offset, which is close to zero on localhost
+    assert abs(data_processor.dfs[3]['dtime'].iloc[0] - (t + timedelta(seconds=1))) < timedelta(seconds=0.1)
+    assert data_processor.dfs[0].empty
+
+
+def test_reset_reaches_the_collector(gateway, collector):
+    data_processor = DataProcessor(collector.number, persist=False, history=False)
+    t = datetime(2026, 1, 1)
+    gateway.publish([encode_sample(0, sample(t + timedelta(seconds=1), 1.0))])
+    assert collect_until(collector, data_processor, lambda: len(data_processor.dfs[2]))
+    # an out of order sample is announced as a reset and the whole frame
+    gateway.publish([encode_sample(0, sample(t, 0.0)), encode_sample(0, sample(t + timedelta(seconds=1), 1.0))],
+                    resets=[0])
+    assert collect_until(collector, data_processor, lambda: len(data_processor.dfs[2]) == 2)
+    assert data_processor.dfs[2]['current'].tolist() == [0.0, 1.0]
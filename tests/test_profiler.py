@@ -0,0 +1,68 @@
+import os
+import time
+import tracemalloc
+
+import pytest
+
+from profiler import Profiler
+
+
+@pytest.fixture
+def profiler(tmp_path):
+    return Profiler(path=str(tmp_path / 'profiles'), slow_cycle=0.05)
+
+
+def run_cycle(profiler, duration=0.0):
+    with profiler.cycle():
+        with profiler.stage('read'):
+            time.sleep(duration)
+        with profiler.stage('plots'):
+            pass
+
+
+def test_slow_cycle_is_logged_with_stages(profiler):
+    run_cycle(profiler)
+    assert not os.path.exists(os.path.join(profiler.path, 'slow_cycles.txt'))
+    run_cycle(profiler, 0.1)
+    with open(os.path.join(profiler.path, 'slow_cycles.txt')) as f:
+        lines = f.readlines()
+    assert len(lines) == 1
+    assert 'read 0.1' in lines[0]
+    assert 'plots 0.0' in lines[0]
+
+
+def test_slow_cycle_check_disabled(tmp_path):
+    profiler = Profiler(path=str(tmp_path / 'profiles'), slow_cycle=0)
+    run_cycle(profiler, 0.01)
+    assert not os.path.exists(profiler.path)
+
+
+def test_profile_of_requested_cycles(profiler):
+    profiler.request_profile(2)
+    run_cycle(profiler)
+    assert not os.path.exists(profiler.path)
+    run_cycle(profiler)
+    names = sorted(os.listdir(profiler.path))
+    assert [os.path.splitext(name)[1] for name in names] == ['.prof', '.txt']
+    with open(os.path.join(profiler.path, names[1])) as f:
+        assert 'function calls' in f.read()
+    assert profiler.profile is None
+
+
+def test_memory_snapshots(profiler):
+    try:
+        profiler.request_snapshot()
+        run_cycle(profiler)
+        run_cycle(profiler)
+        assert len(os.listdir(profiler.path)) == 2
+        profiler.request_snapshot()
+        run_cycle(profiler)
+        assert len(os.listdir(profiler.path)) == 4
+    finally:
+        tracemalloc.stop()
+
+
+def test_file_names_within_a_second_differ(profiler):
+    first = profiler.file_name('cycles', 'prof')
+    time.sleep(0.001)
+    assert profiler.file_name('cycles', 'prof') != first
@@ -1,3 +1,4 @@
+import math
 import time
 
 from PyQt5.QtCore import Qt, QAbstractTableModel, QDateTime, QDate, QObject, pyqtSignal, QTimer
@@ -18,25 +19,36 @@ class MainWindow(QMainWindow):
     create_big_plot = pyqtSignal(int)
     reset_plot = pyqtSignal(int)
     change_data_address = pyqtSignal(int, str)
+    profile_cycles = pyqtSignal(int)
+    memory_snapshot = pyqtSignal()
+    seek_replay = pyqtSignal(str)
 
     def __init__(self, *args, **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
         self.cbox_plot_num = None
         self.edit_address = None
+        self.label_values = None
         self.addresses = {}
+        self.last_values = {}
         self.plot_params = {}
         self.plot_canvas = []
         self.plot_properties = None
+        self.profiler = None
+        self.replay = False
         self.big_plot = BigPlotWindow()
         self.logger = logging.getLogger('main_win')
 
-    def init(self, plots, big_plot, plot_properties):
+    def init(self, plots, big_plot, plot_properties, profiler=None, replay=False):
+        self.profiler = profiler
+        self.replay = replay
         for i, plot in enumerate(plots):
             canvas = MplCanvas(i, self, width=5, height=4, dpi=100)
+            canvas.profiler = profiler
             canvas.set_plot(plot)
             canvas.mpl_connect("button_press_event", self.on_canvas_click)
             self.plot_canvas.append(canvas)
         self.big_plot.set_plot(big_plot)
+        self.big_plot.canvas.profiler = profiler
         self.plot_properties = plot_properties
         self.init_ui()
         # self.build_plot_data(self.plot_canvas)
@@ -44,21 +56,27 @@ class MainWindow(QMainWindow):
     def init_ui(self):
         self.setWindowTitle("Monitor")
         # self.init_menu_bar()
+        self.init_profile_menu()
+        if self.replay:
+            self.init_replay_menu()
 
         central_widget = QWidget()
 
         box = QVBoxLayout()
         grid_layout = QGridLayout()
+        # one cell more for the controls, at least 3 columns
+        columns = max(3, math.ceil(math.sqrt(len(self.plot_canvas) + 1)))
         for i, plot in enumerate(self.plot_canvas):
-            grid_layout.addWidget(plot, i // 3, i % 3)
-        grid_layout.setColumnStretch(0, 1)
-        grid_layout.setColumnStretch(1, 1)
-        grid_layout.setColumnStretch(2, 1)
+            grid_layout.addWidget(plot, i // columns, i % columns)
+        for column in range(columns):
+            grid_layout.setColumnStretch(column, 1)
         box.addLayout(grid_layout)
         control_layout = QVBoxLayout()
-        grid_layout.addLayout(control_layout, 2, 2, alignment=Qt.AlignLeft)
+        control_cell = len(self.plot_canvas)
+        grid_layout.addLayout(control_layout, control_cell // columns, control_cell % columns, alignment=Qt.AlignLeft)
         number_layout = QHBoxLayout()
         address_layout = QHBoxLayout()
+        values_layout = QHBoxLayout()
         reset_layout = QHBoxLayout()
 
         self.cbox_plot_num = QComboBox()
@@ -72,8 +90,11 @@ class MainWindow(QMainWindow):
         self.edit_address.setInputMask('HH:HH:HH:HH:HH:HH')
         self.edit_address.textEdited.connect(self.on_address_edited)
 
+        self.label_values = QLabel()
+
         control_layout.addLayout(number_layout)
         control_layout.addLayout(address_layout)
+        control_layout.addLayout(values_layout)
         control_layout.addLayout(reset_layout)
 
         number_layout.addWidget(QLabel('Plot number'))
@@ -82,6 +103,8 @@ class MainWindow(QMainWindow):
         address_layout.addWidget(QLabel('Address'))
         address_layout.addWidget(self.edit_address)
         address_layout.addStretch()
+        values_layout.addWidget(self.label_values)
+        values_layout.addStretch()
         reset_layout.addWidget(btn_reset)
         reset_layout.addStretch()
         control_layout.addStretch()
@@ -102,12 +125,56 @@ class MainWindow(QMainWindow):
             reset.addAction(act)
             # act.triggered.connect
 
-    def change_plots(self):
-        t0 = time.time()
-        self.logger.debug('change_plots')
-        for canvas in self.plot_canvas:
-            canvas.draw()
-        self.logger.debug(f'end change_plots {round(time.time() - t0, 3)} sec')
+    def init_profile_menu(self):
+        profile = QMenu("&Profile", self)
+        self.menuBar().addMenu(profile)
+        act = QAction(self)
+        act.setText('Profile 10 cycles')
+        act.triggered.connect(lambda: self.profile_cycles.emit(10))
+        profile.addAction(act)
+        act = QAction(self)
+        act.setText('Memory snapshot')
+        act.triggered.connect(lambda: self.memory_snapshot.emit())
+        profile.addAction(act)
+
+    def init_replay_menu(self):
+        replay = QMenu("&Replay", self)
+        self.menuBar().addMenu(replay)
+        act = QAction(self)
+        act.setText('Seek...')
+        act.triggered.connect(self.on_seek_click)
+        replay.addAction(act)
+
+    def on_seek_click(self):
+        text, ok = QInputDialog.getText(self, 'Seek', 'Time (YYYY-MM-DD HH:MM:SS)')
+        if ok and text.strip():
+            self.seek_replay.emit(text.strip())
+
+    def on_data_appended(self, index, seq, rows):
+        # only the new rows are sent, the last one is the latest reading
+        last = rows.iloc[-1]
+        self.last_values[index] = (last['temperature'], last['voltage'], last['current'])
+        self.show_last_values()
+        self.change_plot(index)
+
+    def on_data_reset(self, index, seq):
+        self.last_values.pop(index, None)
+        self.show_last_values()
+        self.change_plot(index)
+
+    def show_last_values(self):
+        index = int(self.cbox_plot_num.currentText()) - 1
+        if index not in self.last_values:
+            self.label_values.setText('')
+            return
+        temperature, voltage, current = self.last_values[index]
+        self.label_values.setText(f'{temperature:.1f} \u00b0C  {voltage:.2f} V  {current:.2f} A')
+
+    def change_plot(self, index):
+        self.logger.debug(f'change_plot #{index}')
+        self.plot_canvas[index].draw_idle()
+        if self.big_plot.number == index:
+            self.draw_big_plot()
 
     def draw_big_plot(self):
         if self.big_plot.isVisible():
@@ -144,6 +211,7 @@ class MainWindow(QMainWindow):
     def on_plot_number_changed(self, evt):
         number = int(self.cbox_plot_num.currentText())
         self.edit_address.setText(self.addresses.get(number, ''))
+        self.show_last_values()
 
 class MplCanvas(FigureCanvasQTAgg):
 
@@ -157,6 +225,13 @@ class MplCanvas(FigureCanvasQTAgg):
         fig.subplots_adjust(right=0.9)
         super(MplCanvas, self).__init__(fig)
         self.__plot = None
+        self.profiler = None
+
+    def draw(self):
+        t0 = time.time()
+        super(MplCanvas, self).draw()
+        if getattr(self, 'profiler', None) is not None:
+            self.profiler.report_draw(f'#{self.number}', time.time() - t0)
 
     def get_plot(self):
         return self.__plot